@@ -1,103 +1,327 @@
 import os
-import git
-import requests
-import time
+import asyncio
+import httpx
 import zipfile
 import io
+import tempfile
+import time
 import json
-from github import Github
+import re
+import math
+import hashlib
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import urllib.parse
-import openai
-from PIL import Image  # 导入 Pillow 库用于获取图像尺寸
-from typing import Optional
+from typing import TYPE_CHECKING, BinaryIO, Dict, List, Optional, Tuple
+
+try:
+    import ijson  # 可选依赖，用于流式解析 event payload
+except ImportError:
+    ijson = None
+
+# git、PyGithub 和 openai 导入较慢，只在真正用到时才导入
+if TYPE_CHECKING:
+    import git
+
+# 需要处理的图片扩展名
+IMAGE_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"})
+# 同时处理的图片数量上限
+MAX_CONCURRENCY = 10
+# 每次 OpenAI 请求中打包总结的 markdown 数量
+SUMMARY_BATCH_SIZE = 20
+# 批量总结的 max_tokens：每条总结的预算（含 id 和 JSON 字段），以及整体 JSON 结构的余量
+SUMMARY_TOKENS_PER_ITEM = 80
+SUMMARY_TOKENS_OVERHEAD = 200
+# 下载 ZIP 时超过该大小才落盘
+ZIP_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+# Mineru 输出 ZIP 中 markdown 文件的名称
+MINERU_MARKDOWN_NAME = "full.md"
+# HTTP 连接池与重试配置
+HTTP_POOL_SIZE = 20
+HTTP_MAX_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+HTTP_MAX_RETRY_AFTER = 60
+# Mineru 任务轮询：初始间隔、退避倍数、最大间隔和总等待时间（秒）
+POLL_INITIAL_DELAY = 0.5
+POLL_BACKOFF = 1.5
+POLL_MAX_DELAY = 8.0
+POLL_TIMEOUT = 120
+
+
+def get_rpm_from_env(name: str, default: float) -> float:
+    """从环境变量读取每分钟请求数，非数字或不大于 0 时回退到默认值"""
+    value = os.environ.get(name, "").strip()
+    # workflow 中未设置的变量会展开为空字符串，按未配置处理
+    if not value:
+        return default
+    try:
+        rpm = float(value)
+    except ValueError:
+        rpm = None
+    if rpm is None or not math.isfinite(rpm) or rpm <= 0:
+        print(f"{name}={value!r} 无效，必须是大于 0 的数字，使用默认值 {default}")
+        return default
+    return rpm
+
+
+# Mineru 创建任务和 OpenAI 请求的每分钟请求数上限
+MINERU_RPM = get_rpm_from_env("MINERU_RPM", 30.0)
+OPENAI_RPM = get_rpm_from_env("OPENAI_RPM", 60.0)
+
+# GitHub API 分页大小（允许的最大值）
+GITHUB_PER_PAGE = 100
+
+# 设置 UPLOAD_ZIPS=0 可跳过把 Mineru 输出上传到 Release
+UPLOAD_ZIPS = os.environ.get("UPLOAD_ZIPS", "1") != "0"
+
+# 总结缓存文件放在 .github/ 下而不是 workflows/ 目录：GITHUB_TOKEN 没有 workflows 权限，
+# 推送 .github/workflows/ 下的改动会被拒绝，导致整批重命名都推送失败
+SUMMARY_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".summary_cache.json")
+
+# push 事件中新增、修改文件的 ijson 路径（字符串或 {"filename": ...} 对象）
+_PUSH_FILE_PREFIXES = frozenset(
+    f"commits.item.{kind}.item{suffix}" for kind in ("added", "modified") for suffix in ("", ".filename")
+)
+
+_release_lock = threading.Lock()
+# 已获取的 {release_name: GitRelease}，由 _release_lock 保护
+_releases: Dict[str, object] = {}
+_OPENAI = None
+
+# 文件名中只保留字母和数字（包括中文），其余连续字符合并为一个下划线
+_INVALID_FILENAME_CHARS = re.compile(r"[\W_]+")
+
+
+class RateLimiter:
+    """按固定间隔发放请求配额，主动控制速率，避免触发接口的 429 限流。"""
 
-def describe_and_rename_image(zip_file_url: str, github_url: str, original_image_path: str, repo: git.Repo, github_token: str, release_name: str):
+    def __init__(self, rpm: float):
+        self.interval = 60 / rpm
+        self.next = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            wait = max(0.0, self.next - now)
+            self.next = max(now, self.next) + self.interval
+        await asyncio.sleep(wait)
+
+
+def create_http_client(**kwargs) -> httpx.AsyncClient:
+    """创建带连接池和连接重试的 HTTP 客户端，在整个批次中复用 keep-alive 连接。"""
+    limits = httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=HTTP_MAX_RETRIES)
+    return httpx.AsyncClient(transport=transport, follow_redirects=True, timeout=60.0, **kwargs)
+
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """读取 Retry-After 响应头中的等待秒数，缺失或无法解析时返回 None。"""
+    try:
+        retry_after = float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+    return min(max(retry_after, 0.0), HTTP_MAX_RETRY_AFTER)
+
+
+async def get_with_retry(client: httpx.AsyncClient, url: str, deadline: Optional[float] = None, **kwargs) -> httpx.Response:
+    """
+    发送 GET 请求，遇到限流或服务端错误时重试：优先按 Retry-After 等待，否则按指数退避。
+    只用于幂等的 GET，创建任务等 POST 请求不能重试，否则可能重复创建。
+    传入 deadline（time.monotonic() 时间）时，重试等待不会超过该时间，到点直接返回最后一次响应。
     """
-    下载 ZIP 文件，解压 markdown 文件，使用大模型总结内容，并重命名原始图像文件。
+    for attempt in range(HTTP_MAX_RETRIES):
+        response = await client.get(url, **kwargs)
+        if response.status_code not in RETRY_STATUS_CODES:
+            return response
+        delay = get_retry_after(response)
+        if delay is None:
+            delay = HTTP_BACKOFF_FACTOR * (2 ** attempt)
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return response
+            delay = min(delay, remaining)
+        await asyncio.sleep(delay)
+    return await client.get(url, **kwargs)
+
+
+async def download_and_extract_markdown(zip_file_url: str, github_token: str, repo_dir: str, release_name: str, client: httpx.AsyncClient, upload_executor: Optional[ThreadPoolExecutor], asset_name: Optional[str], headers: Optional[dict] = None) -> Optional[str]:
     """
+    下载 ZIP 文件，解压出 markdown 内容。传入 upload_executor 时，
+    ZIP 会以 asset_name 为名在后台线程中上传到 Release。
+    """
+    # 流式写入临时文件（小文件留在内存，大文件落盘），避免整个 ZIP 在内存中保留多份
+    zip_file = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
     try:
         print(f"下载 zip 文件: {zip_file_url}")
-        zip_response = requests.get(zip_file_url)
-        zip_response.raise_for_status()
+        async with client.stream("GET", zip_file_url, headers=headers) as zip_response:
+            zip_response.raise_for_status()
+            async for chunk in zip_response.aiter_bytes():
+                zip_file.write(chunk)
+        zip_file.seek(0)
+
+        markdown_content = extract_markdown(zip_file)
+        if upload_executor is not None and asset_name:
+            # 同一个临时文件同时用于解压和上传；上传完成后由后台线程关闭
+            future = upload_executor.submit(upload_zip_to_release, github_token, repo_dir, zip_file, release_name, asset_name)
+            future.add_done_callback(lambda _, f=zip_file: f.close())
+            zip_file = None
 
-        markdown_content = extract_markdown_and_upload_to_release(zip_response.content, github_token, repo.working_dir, release_name)
         if not markdown_content:
             print("ZIP 文件中没有找到 markdown 文件或提取失败")
-            return False
+            return None
+        return markdown_content
 
-        summary = summarize_text_with_openai(markdown_content)
-        if not summary:
-            print("无法总结 Markdown 文件内容")
-            return False
+    except httpx.HTTPError as e:
+        print(f"下载 ZIP 文件失败：{e}")
+        return None
+    except Exception as e:
+        print(f"处理 ZIP 文件出错: {e}")
+        return None
+    finally:
+        if zip_file is not None:
+            zip_file.close()
 
-        local_path = get_local_path_from_github_url(github_url)
-        if not local_path:
-            print("无法解析 GitHub URL")
-            return False
 
+def rename_image(local_path: str, summary: str, repo: "git.Repo", taken_paths: set) -> Optional[str]:
+    """
+    根据总结内容重命名原始图像文件，local_path 为相对仓库根目录的路径。
+    总结相同（例如命中同一条缓存）时依次追加 _2、_3 等后缀，避免目标文件已存在。
+    返回重命名后的路径（文件名无需修改时即 local_path），出错时返回 None。
+    """
+    try:
         filename, ext = os.path.splitext(os.path.basename(local_path))
-        new_filename = sanitize_filename(summary) + ext
-        new_path = os.path.join(os.path.dirname(local_path), new_filename)
+        base_name = sanitize_filename(summary)
+        new_path = os.path.join(os.path.dirname(local_path), base_name + ext)
+        suffix = 2
+        while new_path != local_path and (new_path in taken_paths or os.path.exists(os.path.join(repo.working_dir, new_path))):
+            new_path = os.path.join(os.path.dirname(local_path), f"{base_name}_{suffix}{ext}")
+            suffix += 1
 
+        if new_path == local_path:
+            print(f"文件名无需修改: {local_path}")
+            return local_path
 
         repo.git.mv(local_path, new_path)
+        taken_paths.add(new_path)
         print(f"重命名 {local_path} -> {new_path}")
-        return True
+        return new_path
 
-    except requests.exceptions.RequestException as e:
-        print(f"下载 ZIP 文件失败：{e}")
-        return False
     except Exception as e:
-        print(f"处理 ZIP 文件或重命名文件出错: {e}")
-        return False
+        print(f"重命名文件出错: {e}")
+        return None
 
 
-def extract_markdown_and_upload_to_release(zip_content: bytes, github_token: str, repo_dir: str, release_name: str) -> Optional[str]:
+def extract_markdown(zip_file: BinaryIO) -> Optional[str]:
     """
-    从 ZIP 文件中提取 Markdown 内容，上传 ZIP 到 GitHub Release。
+    从 ZIP 文件中提取 Markdown 内容。
     """
     try:
-        with zipfile.ZipFile(io.BytesIO(zip_content)) as z:
-            markdown_content = None
-            for filename in z.namelist():
-                if filename.endswith(".md"):
-                    with z.open(filename) as f:
-                        markdown_content = f.read().decode("utf-8")
-                        break
-            upload_zip_to_release(github_token, repo_dir, zip_content, release_name)
-            return markdown_content
+        with zipfile.ZipFile(zip_file) as z:
+            # Mineru 输出的 markdown 固定为 full.md，直接按名称查找；找不到时再退回到扫描
+            try:
+                return z.read(MINERU_MARKDOWN_NAME).decode("utf-8")
+            except KeyError:
+                pass
+            md_names = [filename for filename in z.namelist() if filename.endswith(".md")]
+            if not md_names:
+                return None
+            return z.read(md_names[0]).decode("utf-8")
     except Exception as e:
         print(f"处理 ZIP 文件出错: {e}")
         return None
 
 
-def upload_zip_to_release(github_token: str, repo_dir: str, zip_content: bytes, release_name: str):
+@functools.lru_cache(maxsize=1)
+def get_github_repo(github_token: str):
+    """获取当前仓库的 PyGithub 对象，整个进程内只请求一次。"""
+    from github import Github
+
+    return Github(github_token, per_page=GITHUB_PER_PAGE).get_repo(os.environ["GITHUB_REPOSITORY"])
+
+
+def get_or_create_release(github_token: str, release_name: str):
     """
-    上传 ZIP 文件到 GitHub Release。
+    按 tag 获取 Release，不存在时创建。结果会被缓存，后续上传不再访问 API。
+    """
+    from github import UnknownObjectException
+
+    # 上传在多个线程中执行，查缓存和请求都在锁内完成，保证只有第一次调用访问 API
+    with _release_lock:
+        release = _releases.get(release_name)
+        if release is None:
+            repo = get_github_repo(github_token)
+            try:
+                release = repo.get_release(release_name)
+            except UnknownObjectException:
+                release = repo.create_git_release(tag=release_name, name=release_name, message="Release " + release_name, draft=False, prerelease=False)
+            _releases[release_name] = release
+        return release
+
+
+def list_pr_image_files(pr) -> List[str]:
+    """
+    逐页读取 PR 修改的文件，只保留 images 目录下的文件名，不缓存所有 File 对象。
+    """
+    files = []
+    paginated_files = pr.get_files()
+    for page in range(math.ceil(pr.changed_files / GITHUB_PER_PAGE)):
+        page_files = paginated_files.get_page(page)
+        if not page_files:
+            break
+        files.extend(file.filename for file in page_files if file.filename.startswith("images/"))
+    return files
+
+
+def get_image_asset_name(image_path: str) -> Optional[str]:
+    """
+    根据图片内容哈希生成 Mineru 输出在 Release 中的附件名，同一张图片总是对应同一个附件。
+    图片无法读取时返回 None。
     """
     try:
-        g = Github(github_token)
-        repo = g.get_repo(os.environ["GITHUB_REPOSITORY"])
-        release = None
+        with open(image_path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    except OSError as e:
+        print(f"读取图片失败: {e}")
+        return None
+    return f"mineru_output_{digest}.zip"
 
-        for r in repo.get_releases():
-            if r.title == release_name:
-                release = r
-                break
 
-        if release is None:
-            release = repo.create_git_release(tag=release_name, name=release_name, message="Release " + release_name, draft=False, prerelease=False)
+def list_release_assets(github_token: str, release_name: str) -> Dict[str, str]:
+    """列出 Release 中已有的附件 {名称: API 下载地址}，查询失败时返回空字典。"""
+    try:
+        release = get_or_create_release(github_token, release_name)
+        return {asset.name: asset.url for asset in release.get_assets()}
+    except Exception as e:
+        print(f"查询 Release 附件出错: {e}")
+        return {}
 
-        release.upload_asset(data=io.BytesIO(zip_content), name="mineru_output.zip", content_type="application/zip")
-        print(f"成功上传 mineru_output.zip 到 Release {release_name}")
+
+def upload_zip_to_release(github_token: str, repo_dir: str, zip_file: BinaryIO, release_name: str, asset_name: str):
+    """
+    上传 ZIP 文件到 GitHub Release。
+    """
+    try:
+        release = get_or_create_release(github_token, release_name)
+
+        zip_size = zip_file.seek(0, io.SEEK_END)
+        zip_file.seek(0)
+        release.upload_asset_from_memory(zip_file, zip_size, name=asset_name, content_type="application/zip")
+        print(f"成功上传 {asset_name} 到 Release {release_name}")
 
     except Exception as e:
         print(f"上传 ZIP 文件到 Release 出错: {e}")
 
 
-def summarize_text_with_openai(text: str) -> Optional[str]:
-    """使用 OpenAI API 总结文本内容。"""
-    try:
+def get_openai_client():
+    """返回进程内共享的 OpenAI 客户端，首次调用时创建，之后复用同一个连接池。"""
+    global _OPENAI
+    if _OPENAI is None:
+        import openai
+
         openai_api_key = os.environ.get("OPENAI_API_KEY", "dummy_key") # 使用默认值防止报错,不验证key
         openai_api_base = os.environ.get("OPENAI_API_BASE", "https://free.v36.cm") # 使用默认值
 
@@ -105,57 +329,364 @@ def summarize_text_with_openai(text: str) -> Optional[str]:
             print("请设置 OPENAI_API_KEY 环境变量!")
             #return None # 为了方便测试, 使用默认key和base, 不强制退出
 
-        client = openai.OpenAI(
+        _OPENAI = openai.AsyncOpenAI(
             api_key=openai_api_key,
-            base_url=openai_api_base  # 使用环境变量中的 base_url
+            base_url=openai_api_base,  # 使用环境变量中的 base_url
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            max_retries=2,
+            http_client=httpx.AsyncClient(limits=httpx.Limits(max_keepalive_connections=10)),
         )
+    return _OPENAI
 
-        prompt = (
-            "请以简洁准确的方式总结以下内容，总结限制在15个字内，不需要添加任何内容中没有提及的信息，"
-            "如果内容中没有提到某个事物，请不要虚构或猜测它是否存在: \n{text}"
-        ).format(text=text)
-
-        response = client.chat.completions.create(
-            messages=[
-                {'role': 'user', 'content': prompt},  # 使用 prompt
-            ],
-            model='gpt-4o-mini',  # 模型改为 gpt-4o-mini
-            max_tokens=50,
-            temperature=0.3,
-        )
-        summary = response.choices[0].message.content.strip()  # 获取 content
-        return summary
 
-    except openai.error.OpenAIError as e:
+async def summarize_texts_with_openai(texts: List[str], limiter: RateLimiter) -> List[Optional[str]]:
+    """使用 OpenAI API 批量总结文本内容，返回结果与输入按下标对齐，失败的位置为 None。"""
+    import openai
+
+    try:
+        summaries = await request_summaries(texts, limiter)
+    except openai.OpenAIError as e:
         print(f"调用 OpenAI API 出错: {e}")
-        return None
+        return [None] * len(texts)
+    except ValueError as e:
+        print(f"解析总结结果失败: {e}")
+        summaries = [None] * len(texts)
     except Exception as e:
         print(f"总结文本出错: {e}")
-        return None
+        return [None] * len(texts)
+
+    # 整批无法解析或部分 id 缺失时，只把缺失的内容逐条重试，避免少数异常拖累整批图片
+    missing = [index for index, summary in enumerate(summaries) if summary is None]
+    if len(texts) > 1 and missing:
+        print(f"批量总结缺少 {len(missing)}/{len(texts)} 条结果，逐条重试")
+        results = await asyncio.gather(*[summarize_texts_with_openai([texts[index]], limiter) for index in missing])
+        for index, result in zip(missing, results):
+            summaries[index] = result[0]
+    return summaries
+
+
+async def request_summaries(texts: List[str], limiter: RateLimiter) -> List[Optional[str]]:
+    """
+    发送一次批量总结请求并解析结果。回复被截断、不是合法 JSON 或结构不符时抛出 ValueError。
+    """
+    client = get_openai_client()
+
+    # json_object 模式只能返回 JSON 对象，因此把数组包在 summaries 字段里
+    prompt = (
+        "为下列每段内容各生成一个15字以内的中文总结，不需要添加任何内容中没有提及的信息，"
+        "如果内容中没有提到某个事物，请不要虚构或猜测它是否存在。"
+        "以 JSON 对象返回，格式为 {\"summaries\": [{\"id\": 编号, \"summary\": 总结}]}，按编号顺序排列：\n"
+    ) + json.dumps([{'id': i, 'text': t} for i, t in enumerate(texts)], ensure_ascii=False)
+
+    await limiter.acquire()
+    response = await client.chat.completions.create(
+        messages=[
+            {'role': 'user', 'content': prompt},  # 使用 prompt
+        ],
+        model='gpt-4o-mini',  # 模型改为 gpt-4o-mini
+        # 每条总结外还有 id 和 JSON 结构的开销，预留足够余量避免回复被截断
+        max_tokens=SUMMARY_TOKENS_OVERHEAD + SUMMARY_TOKENS_PER_ITEM * len(texts),
+        temperature=0.3,
+        response_format={"type": "json_object"},
+    )
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        raise ValueError("回复超出 max_tokens 被截断")
+    data = json.loads(choice.message.content)  # 获取 content
+    if not isinstance(data, dict):
+        raise ValueError(f"回复不是 JSON 对象: {type(data).__name__}")
+    items = data.get("summaries", [])
+    if not isinstance(items, list):
+        raise ValueError(f"summaries 字段不是数组: {type(items).__name__}")
+
+    summaries: List[Optional[str]] = [None] * len(texts)
+    for position, item in enumerate(items):
+        if isinstance(item, dict):
+            index, summary = item.get("id", position), item.get("summary")
+        else:
+            index, summary = position, item
+        try:
+            index = int(index)  # 模型有时会把 id 返回成字符串
+        except (TypeError, ValueError):
+            continue
+        if 0 <= index < len(texts) and summary:
+            summaries[index] = str(summary).strip()
+    return summaries
+
+
+def get_summary_cache_key(markdown_content: str) -> str:
+    """计算 markdown 内容的哈希，作为总结缓存的键。"""
+    return hashlib.sha1(markdown_content.encode("utf-8")).hexdigest()
+
+
+def load_summary_cache() -> Dict[str, str]:
+    """读取 {内容哈希: 总结} 缓存文件，文件不存在或损坏时返回空字典。"""
+    try:
+        with open(SUMMARY_CACHE_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"读取总结缓存失败: {e}")
+        return {}
+
+
+def save_summary_cache(cache: Dict[str, str]):
+    """写回总结缓存文件，随重命名一起提交到仓库。"""
+    try:
+        with open(SUMMARY_CACHE_PATH, "w", encoding="utf-8") as f:
+            json.dump(cache, f, ensure_ascii=False, indent=2, sort_keys=True)
+    except OSError as e:
+        print(f"写入总结缓存失败: {e}")
 
 
 def sanitize_filename(filename: str) -> str:
     """
     清理文件名，移除特殊字符和空格。
     """
-    return "".join(c if c.isalnum() else "_" for c in filename)
+    return _INVALID_FILENAME_CHARS.sub("_", filename).strip("_") or "image"
 
-def get_local_path_from_github_url(github_url: str) -> Optional[str]:
-    """将 GitHub 网页 URL 转换为本地仓库中的文件路径"""
-    try:
-        parts = github_url.replace("https://github.com/", "").split("/")
-        username = parts[0]
-        repo_name = parts[1]
-        branch = parts[3]
-        file_path = "/".join(parts[4:])
-        return file_path
-    except Exception as e:
-        print(f"解析 GitHub URL 失败: {e}")
-        return None
 
+def get_event_filename(entry) -> Optional[str]:
+    """push 事件中的文件条目通常是字符串，兼容带 filename 字段的对象。"""
+    if isinstance(entry, dict):
+        return entry.get("filename")
+    return entry
+
+
+def parse_event_payload(f: BinaryIO) -> Tuple[Optional[List[str]], Optional[int]]:
+    """
+    解析 GitHub event payload，返回 (push 事件中 images/ 下新增或修改的文件, pull_request 编号)。
+    安装了 ijson 时流式读取，只取需要的字段，不构建整个 payload 对象。
+    """
+    if ijson is None:
+        event_data = json.load(f)
+        files = None
+        if "commits" in event_data:
+            files = []
+            for commit in event_data["commits"]:
+                for entry in commit.get("added", []) + commit.get("modified", []):
+                    filename = get_event_filename(entry)
+                    if filename and filename.startswith("images/"):
+                        files.append(filename)
+        pr_number = event_data.get("pull_request", {}).get("number")
+        return files, pr_number
+
+    files = None
+    pr_number = None
+    for prefix, event, value in ijson.parse(f):
+        if prefix == "" and event == "map_key" and value == "commits":
+            files = []
+        elif prefix in _PUSH_FILE_PREFIXES and event == "string":
+            if value.startswith("images/"):
+                files.append(value)
+        elif prefix == "pull_request.number" and event == "number":
+            pr_number = int(value)
+    return files, pr_number
+
+
+def get_poll_hint(response: httpx.Response, task_data: dict) -> Optional[float]:
+    """从 Retry-After 响应头或任务的 eta 字段中读取服务端建议的下次轮询间隔。"""
+    for value in (response.headers.get("Retry-After"), task_data.get("eta")):
+        try:
+            hint = float(value)
+        except (TypeError, ValueError):
+            continue
+        if hint > 0:
+            return min(max(hint, POLL_INITIAL_DELAY), POLL_TIMEOUT)
+    return None
+
+
+async def fetch_markdown(image_file: str, client: httpx.AsyncClient, mineru_client: httpx.AsyncClient, sem: asyncio.Semaphore, mineru_limiter: RateLimiter, upload_executor: Optional[ThreadPoolExecutor], release_assets: Dict[str, str], asset_name: Optional[str], github_token: str, repo_dir: str, release_name: str, github_repository: str) -> Optional[str]:
+    """
+    处理单张图片：创建 Mineru 任务，轮询结果，下载 ZIP 并提取 markdown 内容。
+    如果 Release 中已经有这张图片的 Mineru 输出，直接从 Release 下载，不再创建任务。
+    """
+    async with sem:
+        file_name = os.path.basename(image_file)
+
+        # 0. 按图片内容查找已归档的 Mineru 输出，命中时不消耗 Mineru 配额
+        asset_url = release_assets.get(asset_name) if asset_name else None
+        if asset_url:
+            print(f"Release 中已有 {file_name} 的 Mineru 输出 {asset_name}，跳过 Mineru 任务")
+            asset_headers = {'Authorization': f'token {github_token}', 'Accept': 'application/octet-stream'}
+            markdown_content = await download_and_extract_markdown(asset_url, github_token, repo_dir, release_name, client, None, asset_name, asset_headers)
+            if markdown_content:
+                return markdown_content
+            print(f"无法使用已归档的输出，重新创建 Mineru 任务: {image_file}")
+
+        # 1.  构造 Mineru API 参数
+        # 构建 github raw url 方便调用mineru API
+        raw_url = f"https://raw.githubusercontent.com/{github_repository}/{release_name}/{image_file}"
+        raw_url_encoded = urllib.parse.quote(raw_url, safe='/:')
+        print(f"Encoded Raw URL: {raw_url_encoded}")
+
+        # 2.  调用 Miner API  创建任务
+        url = '/api/v4/extract/task'
+        data = {
+            'url': raw_url_encoded,
+            'is_ocr': True,
+            'enable_formula': False,
+            'enable_table': True
+        }
+
+        try:
+            await mineru_limiter.acquire()
+            # 创建任务不是幂等操作，不做状态码重试，避免重复创建任务、消耗配额
+            res = await mineru_client.post(url, json=data)
+            res.raise_for_status()
+
+            task_id = res.json().get("data", {}).get("task_id")
+            task_url = f'/api/v4/extract/task/{task_id}'
+        except httpx.HTTPError as e:
+            print(f"调用 Mineru API 失败: {e}")
+            return None  # 继续处理下一个文件
+        except json.JSONDecodeError as e:
+            print(f"解析JSON响应失败：{e}")
+            return None  # 继续处理下一个文件
+        except Exception as e:
+            print(f"发生错误: {e}")
+            return None  # 继续处理下一个文件
+
+        # 3. 轮询任务状态，直到完成
+        # 从短间隔开始逐步退避，总等待时间以 deadline 为上限
+        deadline = time.monotonic() + POLL_TIMEOUT
+        delay = POLL_INITIAL_DELAY
+        attempt = 0
+        full_zip_url = None
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"{file_name} 任务等待超时 ({POLL_TIMEOUT} 秒)")
+                break
+            await asyncio.sleep(min(delay, remaining))
+            attempt += 1
+            try:
+                task_res = await get_with_retry(mineru_client, task_url, deadline=deadline)
+                task_res.raise_for_status()
+                task_data = task_res.json().get("data", {})
+                state = task_data.get("state")
+
+                if state == "done":
+                    full_zip_url = task_data.get("full_zip_url")
+                    break
+                elif state == "failed":
+                    print(f"Mineru API 任务失败: {task_data.get('err_msg')}")
+                    full_zip_url =None
+                    break  # 跳出轮询，并处理下一个文件
+                else:
+                    print(f"{file_name} 任务仍在处理中... (状态: {state}, 尝试次数: {attempt})")
+                    delay = get_poll_hint(task_res, task_data) or min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+            except httpx.HTTPError as e:
+                print(f"查询任务状态失败: {e}")
+                break  # 跳出轮询，并处理下一个文件
+            except json.JSONDecodeError as e:
+                print(f"解析JSON响应失败：{e}")
+                break  # 跳出轮询，并处理下一个文件
+            except Exception as e:
+                print(f"发生错误: {e}")
+                break  # 跳出轮询，并处理下一个文件
+
+        if not full_zip_url:
+            print(f"无法获取 full_zip_url, 跳过该文件: {image_file}")
+            return None #  处理下一个文件
+
+        # 4. 下载 ZIP 并提取 markdown；Release 中已有同名附件时不再重复上传
+        return await download_and_extract_markdown(full_zip_url, github_token, repo_dir, release_name, client, None if asset_url else upload_executor, asset_name)
+
+
+async def process_images(image_files: List[str], repo: "git.Repo", github_token: str, release_name: str, github_repository: str) -> bool:
+    """
+    并发获取所有图片的 markdown 内容，再分批总结并依次重命名。
+    返回 False 表示有图片总结、重命名或提交失败，Mineru 阶段的失败只跳过该文件。
+    """
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    mineru_limiter = RateLimiter(MINERU_RPM)
+    # ZIP 只用于归档，上传放到后台线程，不阻塞总结和重命名
+    upload_executor = ThreadPoolExecutor(max_workers=2) if UPLOAD_ZIPS else None
+    # 已归档的 Mineru 输出只在开始前查询一次，不在每张图片的处理路径上访问 GitHub API
+    release_assets = await asyncio.to_thread(list_release_assets, github_token, release_name) if UPLOAD_ZIPS else {}
+    # Mineru 的鉴权头只在创建客户端时设置一次；下载 ZIP 使用单独的客户端，避免把 token 发给其他域名
+    mineru_headers = {'Authorization': f'Bearer {os.environ.get("MINERU_API_TOKEN")}'}
+    # 按图片内容去重：内容相同的图片只创建一次 Mineru 任务、只上传一次附件
+    # 读取图片并计算哈希是阻塞操作，放到线程中执行，避免阻塞事件循环
+    asset_names = await asyncio.gather(*[
+        asyncio.to_thread(get_image_asset_name, os.path.join(repo.working_dir, image_file))
+        for image_file in image_files
+    ])
+    unique_images: Dict[str, Tuple[str, Optional[str]]] = {}
+    for image_file, asset_name in zip(image_files, asset_names):
+        unique_images.setdefault(asset_name or image_file, (image_file, asset_name))
+    if len(unique_images) < len(image_files):
+        print(f"{len(image_files) - len(unique_images)} 张图片与其他图片内容相同，复用同一个 Mineru 结果")
+
+    async with create_http_client() as client, \
+            create_http_client(base_url=os.environ.get("MINERU_API_ENDPOINT", ""), headers=mineru_headers) as mineru_client:
+        unique_markdowns = await asyncio.gather(*[
+            fetch_markdown(image_file, client, mineru_client, sem, mineru_limiter, upload_executor, release_assets, asset_name, github_token, repo.working_dir, release_name, github_repository)
+            for image_file, asset_name in unique_images.values()
+        ])
+    markdown_by_image = dict(zip(unique_images, unique_markdowns))
+    markdowns = [markdown_by_image[asset_name or image_file] for image_file, asset_name in zip(image_files, asset_names)]
+
+    # 5. 总结 markdown 内容，内容相同的只请求一次，已缓存的不再请求
+    summary_cache = load_summary_cache()
+    cache_keys = {image_file: get_summary_cache_key(markdown_content) for image_file, markdown_content in zip(image_files, markdowns) if markdown_content}
+    texts_by_key = {cache_keys[image_file]: markdown_content for image_file, markdown_content in zip(image_files, markdowns) if markdown_content}
+    pending_keys = [key for key in texts_by_key if key not in summary_cache]
+    print(f"需要总结 {len(pending_keys)} 段内容，命中缓存 {len(texts_by_key) - len(pending_keys)} 段")
+
+    openai_limiter = RateLimiter(OPENAI_RPM)
+    for start in range(0, len(pending_keys), SUMMARY_BATCH_SIZE):
+        batch_keys = pending_keys[start:start + SUMMARY_BATCH_SIZE]
+        summaries = await summarize_texts_with_openai([texts_by_key[key] for key in batch_keys], openai_limiter)
+        for key, summary in zip(batch_keys, summaries):
+            if summary:
+                summary_cache[key] = summary
+    if pending_keys:
+        save_summary_cache(summary_cache)
+
+    # 单张图片失败不中断整个批次，成功的重命名最后统一提交
+    renamed = []
+    taken_paths = set()
+    success = True
+    for image_file, key in cache_keys.items():
+        summary = summary_cache.get(key)
+        if not summary:
+            print(f"无法总结 Markdown 文件内容: {image_file}")
+            success = False
+            continue
+
+        # 6. 重命名图片（image_file 本身就是仓库内的相对路径，无需再经 GitHub URL 转换）
+        new_path = rename_image(image_file, summary, repo, taken_paths)
+        if new_path is None:
+            print(f"重命名图片失败: {image_file}")
+            success = False
+            continue
+        # 文件名本来就正确时没有执行 git mv，不计入重命名数量
+        if new_path != image_file:
+            renamed.append(image_file)
+
+    # 等待后台上传全部完成
+    if upload_executor is not None:
+        await asyncio.to_thread(upload_executor.shutdown, wait=True)
+
+    # 7. 所有重命名（以及更新后的总结缓存）只提交和推送一次
+    if (renamed or pending_keys) and repo.is_dirty(untracked_files=True):
+        repo.git.add(all=True)
+        message = f'重命名 {len(renamed)} 张图片 (AI)' if renamed else '更新图片总结缓存 (AI)'
+        try:
+            repo.git.commit('-m', message)
+            repo.git.push()
+        except Exception as e:
+            print(f"git commit 或 push 失败: {e}")
+            return False
+    return success
 
 
 if __name__ == "__main__":
+    import git
+
     # 获取环境变量
     repo = git.Repo("./", search_parent_directories=True)
     github_token = os.environ.get("GITHUB_TOKEN")
@@ -169,29 +700,21 @@ if __name__ == "__main__":
     # 从环境变量中获取触发事件的文件路径
     event_path = os.environ.get("GITHUB_EVENT_PATH")
     if event_path and os.path.exists(event_path):
-        with open(event_path, "r") as f:
-            event_data = json.load(f)
+        with open(event_path, "rb") as f:
             # 尝试获取所有已修改的文件
-            files = []
-            if "commits" in event_data:  # push 事件
-                for commit in event_data["commits"]:
-                    files.extend([file["filename"] for file in commit.get("added", []) + commit.get("modified", []) if file["filename"].startswith("images/")])
-            elif "pull_request" in event_data:  # pull_request 事件,使用不同的方式获取文件
+            files, pr_number = parse_event_payload(f)  # push 事件直接得到文件列表
+            if files is None and pr_number is not None:  # pull_request 事件,使用不同的方式获取文件
                 print(" pull_request  事件,使用不同的方式获取文件")
                  # 获取 PR 修改的文件列表
-                pull_request = event_data["pull_request"]
-                pr_number = pull_request["number"]
-                g = Github(github_token)
-                repo = g.get_repo(github_repository)
-                pr = repo.get_pull(pr_number)
-                files = [file.filename for file in pr.get_files()  if file.filename.startswith("images/")] # 只获取 images 目录下的文件
-
-            else:
+                pr = get_github_repo(github_token).get_pull(pr_number)
+                files = list_pr_image_files(pr)  # 只获取 images 目录下的文件
+
+            elif files is None:
                 print("不支持的事件类型")
                 exit(1)
 
-            # 过滤掉非图片文件
-            image_files = [file for file in files if file.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".bmp",".webp"))]
+            # 过滤掉非图片文件，同一文件在多个提交中出现时只处理一次
+            image_files = [file for file in dict.fromkeys(files) if os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS]
 
             if not image_files:
                 print("没有找到需要处理的图片文件")
@@ -199,99 +722,8 @@ if __name__ == "__main__":
 
             print(f"需要处理的图片文件: {image_files}")
 
-            for image_file in image_files:
-                # 1.  构造 Mineru API 参数
-                file_name = os.path.basename(image_file)
-                github_url = f"https://github.com/{github_repository}/blob/{release_name}/{image_file}"  # 构造 github_url
-
-                # 获取原始图像的本地路径
-                original_image_path = image_file
-
-                # 构建 github raw url 方便调用mineru API
-                username = github_repository.split("/")[0]
-                repo_name = github_repository.split("/")[1]
-                raw_url = f"https://raw.githubusercontent.com/{username}/{repo_name}/{release_name}/{image_file}"
-                raw_url_encoded = urllib.parse.quote(raw_url, safe='/:')
-                print(f"Encoded Raw URL: {raw_url_encoded}")
-
-                # 2.  调用 Miner API  创建任务
-                mineru_api_endpoint = os.environ.get("MINERU_API_ENDPOINT")
-                mineru_token = os.environ.get("MINERU_API_TOKEN")
-                url = f'{mineru_api_endpoint}/api/v4/extract/task'
-                headers = {
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {mineru_token}'
-                }
-                data = {
-                    'url': raw_url_encoded,
-                    'is_ocr': True,
-                    'enable_formula': False,
-                    'enable_table': True
-                }
-
-                try:
-                    res = requests.post(url, headers=headers, json=data)
-                    res.raise_for_status()
-
-                    task_id = res.json().get("data", {}).get("task_id")
-                    task_url = f'{mineru_api_endpoint}/api/v4/extract/task/{task_id}'
-                except requests.exceptions.RequestException as e:
-                    print(f"调用 Mineru API 失败: {e}")
-                    continue  # 继续处理下一个文件
-                except json.JSONDecodeError as e:
-                    print(f"解析JSON响应失败：{e}")
-                    continue  # 继续处理下一个文件
-                except Exception as e:
-                    print(f"发生错误: {e}")
-                    continue  # 继续处理下一个文件
-
-                # 3. 轮询任务状态，直到完成
-                max_retries = 20
-                retry_delay = 5
-                full_zip_url = None
-                for attempt in range(max_retries):
-                    time.sleep(retry_delay)
-                    try:
-                        task_res = requests.get(task_url, headers=headers)
-                        task_res.raise_for_status()
-                        task_data = task_res.json().get("data", {})
-                        state = task_data.get("state")
-
-                        if state == "done":
-                            full_zip_url = task_data.get("full_zip_url")
-                            break
-                        elif state == "failed":
-                            print(f"Mineru API 任务失败: {task_data.get('err_msg')}")
-                            full_zip_url =None
-                            break  # 跳出轮询，并处理下一个文件
-                        else:
-                            print(f"任务仍在处理中... (状态: {state}, 尝试次数: {attempt + 1}/{max_retries})")
-                    except requests.exceptions.RequestException as e:
-                        print(f"查询任务状态失败: {e}")
-                        break  # 跳出轮询，并处理下一个文件
-                    except json.JSONDecodeError as e:
-                        print(f"解析JSON响应失败：{e}")
-                        break  # 跳出轮询，并处理下一个文件
-                    except Exception as e:
-                        print(f"发生错误: {e}")
-                        break  # 跳出轮询，并处理下一个文件
-
-                if not full_zip_url:
-                    print("无法获取 full_zip_url, 跳过该文件")
-                    continue #  处理下一个文件
-                # 4. 描述图片和重命名图片
-                if describe_and_rename_image(full_zip_url, github_url,original_image_path, repo, github_token, release_name):
-                    repo.git.add(all=True)
-                    try:
-                        repo.git.commit('-m', f'重命名图片 (AI): {file_name}')
-                        repo.git.push()
-                    except Exception as e:
-                        print(f"git commit 或 push 失败: {e}")
-                        exit(1)
-
-                else:
-                    print("重命名图片失败")
-                    exit(1)
+            if not asyncio.run(process_images(image_files, repo, github_token, release_name, github_repository)):
+                exit(1)
     else:
         print("未找到 event payload 文件")
         exit(1)